@@ -22,10 +22,14 @@ OpenWebRX csdr plugin: do the signal processing with csdr
 
 import subprocess
 import os
+import shlex
 import signal
+import stat
+import socket
 import threading
 from functools import partial
 from owrx.wsjt import Ft8Chopper, WsprChopper, Jt9Chopper, Jt65Chopper, Ft4Chopper
+import numbadsp
 
 import logging
 logger = logging.getLogger(__name__)
@@ -56,6 +60,7 @@ class dsp(object):
         self.name = "csdr"
         self.base_bufsize = 512
         self.nc_port = 4951
+        self.nc_format = "f32"
         self.csdr_dynamic_bufsize = False
         self.csdr_print_bufsizes = False
         self.csdr_through = False
@@ -73,16 +78,49 @@ class dsp(object):
         self.secondary_offset_freq = 1000
         self.unvoiced_quality = 1
         self.modification_lock = threading.Lock()
+        self.inprocess_chain = None
+        self.dmr_control_pipe_fd = None
+        self.command_cache = None
         self.output = output
         self.temporary_directory = "/tmp"
+        self.calculate_decimation()
+        self.calculate_fft_block_size()
 
     def set_temporary_directory(self, what):
         self.temporary_directory = what
 
-    def chain(self,which):
-        chain = ["nc -v 127.0.0.1 {nc_port}"]
+    # chain templates only depend on the handful of options hashed in chain_key(), not on
+    # the numeric parameters, so the assembled templates are shared across all dsp
+    # instances and restarts instead of being rebuilt on every start
+    chain_cache = {}
+
+    # the nmux stream is in the device's native format; the chains convert it to float
+    # themselves, so the fat float stream never crosses nmux or the iq sockets
+    format_conversions = {
+        "u8": "csdr convert_u8_f",
+        "s8": "csdr convert_s8_f",
+        "s16": "csdr convert_s16_f"
+    }
+
+    def chain_key(self, which):
+        return (which, self.nc_format, self.csdr_dynamic_bufsize, self.csdr_through, self.fft_compression,
+                self.fft_averages == 0, self.secondary_demodulator is not None,
+                self.last_decimation == 1.0, self.audio_compression,
+                self.isWsjtMode() and self.get_audio_rate() != self.get_output_rate())
+
+    def chain(self, which):
+        key = self.chain_key(which)
+        if key not in dsp.chain_cache:
+            dsp.chain_cache[key] = self.build_chain(which)
+        return dsp.chain_cache[key]
+
+    def build_chain(self,which):
+        # no nc head here: the first stage reads straight from the nmux socket
+        chain = []
         if self.csdr_dynamic_bufsize: chain += ["csdr setbuf {start_bufsize}"]
         if self.csdr_through: chain += ["csdr through"]
+        if self.nc_format in dsp.format_conversions:
+            chain += [dsp.format_conversions[self.nc_format]]
         if which == "fft":
             chain += [
                 "csdr fft_cc {fft_size} {fft_block_size}",
@@ -264,10 +302,13 @@ class dsp(object):
         my_env=os.environ.copy()
         #if self.csdr_dynamic_bufsize: my_env["CSDR_DYNAMIC_BUFSIZE_ON"]="1";
         if self.csdr_print_bufsizes: my_env["CSDR_PRINT_BUFSIZES"]="1";
-        self.secondary_process_fft = subprocess.Popen(secondary_command_fft, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setpgrp, env=my_env)
+        self.secondary_processes_fft = self.spawn_pipeline(secondary_command_fft, my_env)
+        self.secondary_process_fft = self.secondary_processes_fft[-1]
         logger.debug("[openwebrx-dsp-plugin:csdr] Popen on secondary command (fft)")
-        self.secondary_process_demod = subprocess.Popen(secondary_command_demod, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setpgrp, env=my_env) #TODO digimodes
+        self.secondary_processes_demod = self.spawn_pipeline(secondary_command_demod, my_env) #TODO digimodes
+        self.secondary_process_demod = self.secondary_processes_demod[-1]
         logger.debug("[openwebrx-dsp-plugin:csdr] Popen on secondary command (demod)") #TODO digimodes
+        self.tune_scheduling(self.secondary_processes_fft + self.secondary_processes_demod)
         self.secondary_processes_running = True
 
         self.output.add_output("secondary_fft", partial(self.secondary_process_fft.stdout.read, int(self.get_secondary_fft_bytes_to_read())))
@@ -290,30 +331,21 @@ class dsp(object):
 
         #open control pipes for csdr and send initialization data
         if self.secondary_shift_pipe != None: #TODO digimodes
-            self.secondary_shift_pipe_file=open(self.secondary_shift_pipe,"w") #TODO digimodes
+            self.secondary_shift_pipe_fd = os.open(self.secondary_shift_pipe, os.O_WRONLY) #TODO digimodes
+            self.secondary_shift_scale = -1.0/self.if_samp_rate()
             self.set_secondary_offset_freq(self.secondary_offset_freq) #TODO digimodes
 
     def set_secondary_offset_freq(self, value):
         self.secondary_offset_freq=value
-        if self.secondary_processes_running and hasattr(self, "secondary_shift_pipe_file"):
-            self.secondary_shift_pipe_file.write("%g\n"%(-float(self.secondary_offset_freq)/self.if_samp_rate()))
-            self.secondary_shift_pipe_file.flush()
+        if self.secondary_processes_running and hasattr(self, "secondary_shift_pipe_fd"):
+            os.write(self.secondary_shift_pipe_fd, b"%g\n"%(self.secondary_offset_freq*self.secondary_shift_scale))
 
     def stop_secondary_demodulator(self):
         if self.secondary_processes_running == False: return
-        self.try_delete_pipes(self.secondary_pipe_names)
         if self.secondary_process_fft:
-            try:
-                os.killpg(os.getpgid(self.secondary_process_fft.pid), signal.SIGTERM)
-            except ProcessLookupError:
-                # been killed by something else, ignore
-                pass
+            self.kill_pipeline(self.secondary_processes_fft)
         if self.secondary_process_demod:
-            try:
-                os.killpg(os.getpgid(self.secondary_process_demod.pid), signal.SIGTERM)
-            except ProcessLookupError:
-                # been killed by something else, ignore
-                pass
+            self.kill_pipeline(self.secondary_processes_demod)
         self.secondary_processes_running = False
 
     def get_secondary_demodulator(self):
@@ -340,10 +372,21 @@ class dsp(object):
     def set_samp_rate(self,samp_rate):
         self.samp_rate=samp_rate
         self.calculate_decimation()
+        self.calculate_fft_block_size()
         if self.running: self.restart()
 
     def calculate_decimation(self):
-        (self.decimation, self.last_decimation, _) = self.get_decimation(self.samp_rate, self.get_audio_rate())
+        # every setter that can influence the derived rates funnels through here, so the
+        # values handed out by the getters below are precomputed instead of being derived
+        # again on every call
+        self.cached_audio_rate = 48000 if self.isDigitalVoice() else 12000 if self.isWsjtMode() else self.output_rate
+        (self.decimation, self.last_decimation, _) = self.get_decimation(self.samp_rate, self.cached_audio_rate)
+        self.cached_if_samp_rate = self.samp_rate / self.decimation
+        self.cached_ddc_transition_bw = self.ddc_transition_bw_rate * (self.cached_if_samp_rate / float(self.samp_rate))
+
+    def calculate_fft_block_size(self):
+        if self.fft_averages == 0: self.cached_fft_block_size = self.samp_rate / self.fft_fps
+        else: self.cached_fft_block_size = self.samp_rate / self.fft_fps / self.fft_averages
 
     def get_decimation(self, input_rate, output_rate):
         decimation=1
@@ -354,7 +397,7 @@ class dsp(object):
         return (decimation, fraction, intermediate_rate)
 
     def if_samp_rate(self):
-        return self.samp_rate/self.decimation
+        return self.cached_if_samp_rate
 
     def get_name(self):
         return self.name
@@ -363,11 +406,7 @@ class dsp(object):
         return self.output_rate
 
     def get_audio_rate(self):
-        if self.isDigitalVoice():
-            return 48000
-        elif self.isWsjtMode():
-            return 12000
-        return self.get_output_rate()
+        return self.cached_audio_rate
 
     def isDigitalVoice(self, demodulator = None):
         if demodulator is None:
@@ -398,31 +437,36 @@ class dsp(object):
 
     def set_fft_fps(self,fft_fps):
         self.fft_fps=fft_fps
+        self.calculate_fft_block_size()
         self.restart()
 
     def set_fft_averages(self,fft_averages):
         self.fft_averages=fft_averages
+        self.calculate_fft_block_size()
         self.restart()
 
     def fft_block_size(self):
-        if self.fft_averages == 0: return self.samp_rate/self.fft_fps
-        else: return self.samp_rate/self.fft_fps/self.fft_averages
+        return self.cached_fft_block_size
 
     def set_offset_freq(self,offset_freq):
         self.offset_freq=offset_freq
         if self.running:
+            if self.inprocess_chain:
+                self.inprocess_chain.set_offset_freq(offset_freq)
+                return
             self.modification_lock.acquire()
-            self.shift_pipe_file.write("%g\n"%(-float(self.offset_freq)/self.samp_rate))
-            self.shift_pipe_file.flush()
+            os.write(self.shift_pipe_fd, b"%g\n"%(self.offset_freq*self.offset_freq_scale))
             self.modification_lock.release()
 
     def set_bpf(self,low_cut,high_cut):
         self.low_cut=low_cut
         self.high_cut=high_cut
         if self.running:
+            if self.inprocess_chain:
+                self.inprocess_chain.set_bpf(low_cut, high_cut)
+                return
             self.modification_lock.acquire()
-            self.bpf_pipe_file.write( "%g %g\n"%(float(self.low_cut)/self.if_samp_rate(), float(self.high_cut)/self.if_samp_rate()) )
-            self.bpf_pipe_file.flush()
+            os.write(self.bpf_pipe_fd, b"%g %g\n"%(self.low_cut*self.bpf_scale, self.high_cut*self.bpf_scale))
             self.modification_lock.release()
 
     def get_bpf(self):
@@ -433,9 +477,11 @@ class dsp(object):
         #no squelch required on digital voice modes
         actual_squelch = 0 if self.isDigitalVoice() else self.squelch_level
         if self.running:
+            if self.inprocess_chain:
+                self.inprocess_chain.set_squelch_level(actual_squelch)
+                return
             self.modification_lock.acquire()
-            self.squelch_pipe_file.write("%g\n"%(float(actual_squelch)))
-            self.squelch_pipe_file.flush()
+            os.write(self.squelch_pipe_fd, b"%g\n"%(actual_squelch))
             self.modification_lock.release()
 
     def set_unvoiced_quality(self, q):
@@ -446,19 +492,21 @@ class dsp(object):
         return self.unvoiced_quality
 
     def set_dmr_filter(self, filter):
-        if self.dmr_control_pipe_file:
-            self.dmr_control_pipe_file.write("{0}\n".format(filter))
-            self.dmr_control_pipe_file.flush()
+        if self.dmr_control_pipe_fd is not None:
+            os.write(self.dmr_control_pipe_fd, "{0}\n".format(filter).encode())
 
     def mkfifo(self,path):
+        # fifos are kept across restarts; only recreate when missing or not a fifo
         try:
+            if stat.S_ISFIFO(os.stat(path).st_mode):
+                return
             os.unlink(path)
-        except:
+        except OSError:
             pass
         os.mkfifo(path)
 
     def ddc_transition_bw(self):
-        return self.ddc_transition_bw_rate*(self.if_samp_rate()/float(self.samp_rate))
+        return self.cached_ddc_transition_bw
 
     def try_create_pipes(self, pipe_names, command_base):
         for pipe_name in pipe_names:
@@ -466,6 +514,13 @@ class dsp(object):
                 setattr(self, pipe_name, self.pipe_base_path+pipe_name)
                 self.mkfifo(getattr(self, pipe_name))
             else:
+                # drop fifos left over from a previous chain that no longer uses them
+                old_path = getattr(self, pipe_name, None)
+                if old_path:
+                    try:
+                        os.unlink(old_path)
+                    except OSError:
+                        pass
                 setattr(self, pipe_name, None)
 
     def try_delete_pipes(self, pipe_names):
@@ -473,9 +528,68 @@ class dsp(object):
             pipe_path = getattr(self,pipe_name,None)
             if pipe_path:
                 try: os.unlink(pipe_path)
+                except FileNotFoundError:
+                    # already gone, nothing to do
+                    pass
                 except Exception:
                     logger.exception("try_delete_pipes()")
 
+    def spawn_pipeline(self, command, env, stdin = None):
+        # spawns the pipeline stages individually instead of handing the whole chain to a
+        # shell. the stages are connected with cloexec pipes created by the interpreter
+        # via pipe2(), and dropping the shell and the preexec hook lets it take its
+        # vfork/posix_spawn fast path, so each (re)start saves a shell plus a full
+        # fork+exec per stage. returns the list of stage processes, last one owns stdout.
+        # stdin, when given, is handed to the first stage and closed here.
+        processes = []
+        for stage in command.split(" | "):
+            args = shlex.split(stage)
+            stage_env = env
+            # VAR=value prefixes (e.g. CSDR_FIXED_BUFSIZE=32) go into the environment
+            while "=" in args[0]:
+                (key, value) = args[0].split("=", 1)
+                if stage_env is env: stage_env = env.copy()
+                stage_env[key] = value
+                args = args[1:]
+            p = subprocess.Popen(args, stdin=stdin, stdout=subprocess.PIPE, start_new_session=True, env=stage_env)
+            if stdin is not None:
+                # the child owns this end now
+                stdin.close()
+            stdin = p.stdout
+            processes.append(p)
+        return processes
+
+    def tune_scheduling(self, processes):
+        # best effort: keep the dsp stages off cpu 0, where the webserver and websocket
+        # threads tend to land, so heavy asset traffic does not starve the audio path.
+        # silently degrades on single-core machines or where the api is missing.
+        try:
+            cpus = os.cpu_count()
+            if cpus is not None and cpus > 1:
+                for p in processes:
+                    os.sched_setaffinity(p.pid, range(1, cpus))
+        except (OSError, AttributeError):
+            pass
+
+    def kill_pipeline(self, processes):
+        for p in processes:
+            try:
+                os.killpg(os.getpgid(p.pid), signal.SIGTERM)
+            except ProcessLookupError:
+                # been killed by something else, ignore
+                pass
+
+    def chain_params(self):
+        # everything the chain templates can reference; built once per start
+        return dict(bpf_pipe=self.bpf_pipe, shift_pipe=self.shift_pipe, decimation=self.decimation,
+            last_decimation=self.last_decimation, fft_size=self.fft_size, fft_block_size=self.fft_block_size(), fft_averages=self.fft_averages,
+            bpf_transition_bw=float(self.bpf_transition_bw)/self.if_samp_rate(), ddc_transition_bw=self.ddc_transition_bw(),
+            flowcontrol=int(self.samp_rate*2), start_bufsize=self.base_bufsize*self.decimation, nc_port=self.nc_port,
+            squelch_pipe=self.squelch_pipe, smeter_pipe=self.smeter_pipe, meta_pipe=self.meta_pipe, iqtee_pipe=self.iqtee_pipe, iqtee2_pipe=self.iqtee2_pipe,
+            output_rate = self.get_output_rate(), smeter_report_every = int(self.if_samp_rate()/6000),
+            unvoiced_quality = self.get_unvoiced_quality(), dmr_control_pipe = self.dmr_control_pipe,
+            audio_rate = self.get_audio_rate())
+
     def start(self):
         self.modification_lock.acquire()
         if (self.running):
@@ -483,7 +597,18 @@ class dsp(object):
             return
         self.running = True
 
-        command_base = " | ".join(self.chain(self.demodulator))
+        # the numba chains cover the analog modes and the fft in-process; everything else
+        # still goes through the csdr subprocess pipeline
+        chain = numbadsp.create_chain(self)
+        if chain is not None:
+            logger.debug("[openwebrx-dsp-plugin:csdr] starting in-process chain %s", type(chain).__name__)
+            self.inprocess_chain = chain
+            chain.start()
+            self.modification_lock.release()
+            return
+
+        stages = self.chain(self.demodulator)
+        command_base = " | ".join(stages)
         logger.debug(command_base)
 
         #create control pipes for csdr
@@ -491,21 +616,25 @@ class dsp(object):
 
         self.try_create_pipes(self.pipe_names, command_base)
 
-        #run the command
-        command=command_base.format( bpf_pipe=self.bpf_pipe, shift_pipe=self.shift_pipe, decimation=self.decimation,
-            last_decimation=self.last_decimation, fft_size=self.fft_size, fft_block_size=self.fft_block_size(), fft_averages=self.fft_averages,
-            bpf_transition_bw=float(self.bpf_transition_bw)/self.if_samp_rate(), ddc_transition_bw=self.ddc_transition_bw(),
-            flowcontrol=int(self.samp_rate*2), start_bufsize=self.base_bufsize*self.decimation, nc_port=self.nc_port,
-            squelch_pipe=self.squelch_pipe, smeter_pipe=self.smeter_pipe, meta_pipe=self.meta_pipe, iqtee_pipe=self.iqtee_pipe, iqtee2_pipe=self.iqtee2_pipe,
-            output_rate = self.get_output_rate(), smeter_report_every = int(self.if_samp_rate()/6000),
-            unvoiced_quality = self.get_unvoiced_quality(), dmr_control_pipe = self.dmr_control_pipe,
-            audio_rate = self.get_audio_rate())
+        # format each stage on its own, skipping the ones without placeholders; the
+        # result is cached so a restart with unchanged parameters skips the whole pass
+        params = self.chain_params()
+        key = (command_base, tuple(sorted(params.items())))
+        if self.command_cache is None or self.command_cache[0] != key:
+            command = " | ".join(stage if "{" not in stage else stage.format(**params) for stage in stages)
+            self.command_cache = (key, command)
+        command = self.command_cache[1]
 
         logger.debug("[openwebrx-dsp-plugin:csdr] Command = %s", command)
         my_env=os.environ.copy()
         if self.csdr_dynamic_bufsize: my_env["CSDR_DYNAMIC_BUFSIZE_ON"]="1";
         if self.csdr_print_bufsizes: my_env["CSDR_PRINT_BUFSIZES"]="1";
-        self.process = subprocess.Popen(command, stdout=subprocess.PIPE, shell=True, preexec_fn=os.setpgrp, env=my_env)
+        # feed the chain directly from the nmux socket instead of an nc process; the
+        # first stage reads the stream from its stdin without the extra pipe hop
+        iq_socket = socket.create_connection(("127.0.0.1", self.nc_port))
+        self.processes = self.spawn_pipeline(command, my_env, stdin = iq_socket)
+        self.tune_scheduling(self.processes)
+        self.process = self.processes[-1]
 
         def watch_thread():
             rc = self.process.wait()
@@ -518,13 +647,17 @@ class dsp(object):
 
         self.output.add_output("audio", partial(self.process.stdout.read, int(self.get_fft_bytes_to_read()) if self.demodulator == "fft" else 256))
 
-        # open control pipes for csdr
+        # open control pipes for csdr; raw fds so every update is a single write syscall
+        # with no stream buffering in between. the scale factors only depend on the
+        # rates, which cannot change without a restart, so they are computed here once.
+        self.offset_freq_scale = -1.0/self.samp_rate
+        self.bpf_scale = 1.0/self.if_samp_rate()
         if self.bpf_pipe:
-            self.bpf_pipe_file = open(self.bpf_pipe, "w")
+            self.bpf_pipe_fd = os.open(self.bpf_pipe, os.O_WRONLY)
         if self.shift_pipe:
-            self.shift_pipe_file = open(self.shift_pipe, "w")
+            self.shift_pipe_fd = os.open(self.shift_pipe, os.O_WRONLY)
         if self.squelch_pipe:
-            self.squelch_pipe_file = open(self.squelch_pipe, "w")
+            self.squelch_pipe_fd = os.open(self.squelch_pipe, os.O_WRONLY)
         self.start_secondary_demodulator()
 
         self.modification_lock.release()
@@ -537,13 +670,22 @@ class dsp(object):
         if self.bpf_pipe:
             self.set_bpf(self.low_cut, self.high_cut)
         if self.smeter_pipe:
-            self.smeter_pipe_file=open(self.smeter_pipe,"r")
+            self.smeter_pipe_fd = os.open(self.smeter_pipe, os.O_RDONLY)
+            smeter_buf = bytearray()
             def read_smeter():
-                raw = self.smeter_pipe_file.readline()
-                if len(raw) == 0:
-                    return None
-                else:
-                    return float(raw.rstrip("\n"))
+                # drain whatever has accumulated in the fifo with one read and report
+                # only the newest level; older values are stale by the time they could
+                # reach the client anyway
+                while True:
+                    newline = smeter_buf.rfind(b"\n")
+                    if newline >= 0:
+                        last = bytes(smeter_buf[smeter_buf.rfind(b"\n", 0, newline) + 1:newline])
+                        del smeter_buf[:newline + 1]
+                        return float(last)
+                    data = os.read(self.smeter_pipe_fd, 4096)
+                    if len(data) == 0:
+                        return None
+                    smeter_buf.extend(data)
             self.output.add_output("smeter", read_smeter)
         if self.meta_pipe != None:
             # TODO make digiham output unicode and then change this here
@@ -557,21 +699,29 @@ class dsp(object):
             self.output.add_output("meta", read_meta)
 
         if self.dmr_control_pipe:
-            self.dmr_control_pipe_file = open(self.dmr_control_pipe, "w")
+            self.dmr_control_pipe_fd = os.open(self.dmr_control_pipe, os.O_WRONLY)
 
     def stop(self):
         self.modification_lock.acquire()
         self.running = False
-        if hasattr(self, "process"):
-            try:
-                os.killpg(os.getpgid(self.process.pid), signal.SIGTERM)
-            except ProcessLookupError:
-                # been killed by something else, ignore
-                pass
+        if self.inprocess_chain:
+            self.inprocess_chain.stop()
+            self.inprocess_chain = None
+        if hasattr(self, "processes"):
+            self.kill_pipeline(self.processes)
         self.stop_secondary_demodulator()
 
-        self.try_delete_pipes(self.pipe_names)
-
+        for attr in ["bpf_pipe_fd", "shift_pipe_fd", "squelch_pipe_fd", "smeter_pipe_fd", "dmr_control_pipe_fd", "secondary_shift_pipe_fd"]:
+            fd = getattr(self, attr, None)
+            if fd is not None:
+                try:
+                    os.close(fd)
+                except OSError:
+                    pass
+                setattr(self, attr, None)
+
+        # fifos stay in place so a restart (triggered by most ui setters) can reuse
+        # them; they are removed for good in __del__
         self.modification_lock.release()
 
     def restart(self):
@@ -581,4 +731,6 @@ class dsp(object):
 
     def __del__(self):
         self.stop()
-        del(self.process)
+        self.try_delete_pipes(self.pipe_names + self.secondary_pipe_names)
+        if hasattr(self, "process"):
+            del(self.process)
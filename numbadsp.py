@@ -0,0 +1,814 @@
+"""
+OpenWebRX numba dsp plugin: do the signal processing in-process with NumPy and Numba
+
+    This file is part of OpenWebRX,
+    an open-source SDR receiver software with a web UI.
+    Copyright (c) 2013-2015 by Andras Retzler <randras@sdr.hu>
+
+    This program is free software: you can redistribute it and/or modify
+    it under the terms of the GNU Affero General Public License as
+    published by the Free Software Foundation, either version 3 of the
+    License, or (at your option) any later version.
+
+    This program is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU Affero General Public License for more details.
+
+    You should have received a copy of the GNU Affero General Public License
+    along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+
+import math
+import os
+import socket
+import threading
+
+import logging
+logger = logging.getLogger(__name__)
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+# how much we pull off the iq socket in one go
+CHUNK_SIZE = 65536
+
+# should be the same as in csdr.c and openwebrx.js
+COMPRESS_FFT_PAD_N = 10
+
+
+def available():
+    return np is not None
+
+
+def _jit(fn):
+    # kernels are compiled on first call and cached on disk afterwards, so only the very
+    # first start on a fresh installation pays the compilation delay.
+    if njit is None:
+        return fn
+    return njit(cache=True, fastmath=True)(fn)
+
+
+@_jit
+def _fir_decimate_cc(buf, total, taps, decimation, out):
+    taps_n = taps.shape[0]
+    n_out = (total - taps_n) // decimation + 1 if total >= taps_n else 0
+    for k in range(n_out):
+        acc = complex(0.0, 0.0)
+        base = k * decimation
+        for t in range(taps_n):
+            acc += buf[base + t] * taps[t]
+        out[k] = acc
+    return n_out
+
+
+@_jit
+def _fir_cc(buf, total, taps, out):
+    taps_n = taps.shape[0]
+    n_out = total - taps_n + 1 if total >= taps_n else 0
+    for k in range(n_out):
+        acc = complex(0.0, 0.0)
+        for t in range(taps_n):
+            acc += buf[k + t] * taps[t]
+        out[k] = acc
+    return n_out
+
+
+# numpy fallbacks for the block-rate kernels, used when numba is not installed (numba is
+# hard to come by on some arm distributions, numpy is not). the decimator computes only
+# the kept output samples via a strided view, so the dot products run in numpy's simd
+# loops (neon on arm) instead of a python loop over discarded samples.
+
+def _fir_decimate_cc_numpy(buf, total, taps, decimation, out):
+    taps_n = taps.shape[0]
+    n_out = (total - taps_n) // decimation + 1 if total >= taps_n else 0
+    if n_out > 0:
+        windows = np.lib.stride_tricks.as_strided(
+            buf, shape=(n_out, taps_n),
+            strides=(buf.strides[0] * decimation, buf.strides[0])
+        )
+        out[:n_out] = windows @ taps
+    return n_out
+
+
+def _fir_cc_numpy(buf, total, taps, out):
+    taps_n = taps.shape[0]
+    n_out = total - taps_n + 1 if total >= taps_n else 0
+    if n_out > 0:
+        # convolve reverses the taps, so reversing them here makes it a plain fir
+        out[:n_out] = np.convolve(buf[:total], taps[::-1], mode="valid")
+    return n_out
+
+
+def _fmdemod_numpy(inp, n, last, out):
+    d = inp[:n] * np.conj(np.concatenate((np.array([last], dtype=np.complex64), inp[:n - 1])))
+    np.arctan2(d.imag, d.real, out=out[:n])
+    out[:n] /= np.pi
+    return complex(inp[n - 1])
+
+
+def _fractional_decimate_numpy(inp, n, rate, pos, out):
+    if pos >= n - 1:
+        return 0, pos
+    k = int(math.floor((n - 1 - 1e-9 - pos) / rate)) + 1
+    idx = pos + rate * np.arange(k)
+    base = idx.astype(np.int64)
+    frac = (idx - base).astype(np.float32)
+    out[:k] = inp[base] * (1.0 - frac) + inp[base + 1] * frac
+    return k, pos + rate * k
+
+
+if np is not None:
+    # standard ima adpcm tables, matching the decoder shipped in sdr.js
+    _ADPCM_STEP_TABLE = np.array([
+        7, 8, 9, 10, 11, 12, 13, 14, 16, 17, 19, 21, 23, 25, 28, 31, 34, 37, 41, 45,
+        50, 55, 60, 66, 73, 80, 88, 97, 107, 118, 130, 143, 157, 173, 190, 209, 230,
+        253, 279, 307, 337, 371, 408, 449, 494, 544, 598, 658, 724, 796, 876, 963,
+        1060, 1166, 1282, 1411, 1552, 1707, 1878, 2066, 2272, 2499, 2749, 3024, 3327,
+        3660, 4026, 4428, 4871, 5358, 5894, 6484, 7132, 7845, 8630, 9493, 10442,
+        11487, 12635, 13899, 15289, 16818, 18500, 20350, 22385, 24623, 27086, 29794,
+        32767
+    ], dtype=np.int32)
+    _ADPCM_INDEX_TABLE = np.array([
+        -1, -1, -1, -1, 2, 4, 6, 8, -1, -1, -1, -1, 2, 4, 6, 8
+    ], dtype=np.int32)
+
+
+@_jit
+def _fft_compress_adpcm(power, n_avg, pad_n, out, step_table, index_table):
+    # fuses averaging, dB conversion, the side exchange and the ima adpcm compression of
+    # one fft frame into a single traversal: every bin is read once and one nibble is
+    # written. the encoder state restarts on every frame, like compress_fft_adpcm_f_u8.
+    n = power.shape[0]
+    half = n >> 1
+    predictor = 0
+    index = 0
+    low_nibble = 0
+    total = n + pad_n
+    for j in range(total):
+        if j < pad_n:
+            src = half  # csdr pads each frame with copies of the first output bin
+        else:
+            src = j - pad_n + half
+            if src >= n:
+                src -= n
+        db = 10.0 * math.log10(power[src] / n_avg + 1e-20) - 70.0
+        sample = int(db * 100.0)
+        if sample > 32767: sample = 32767
+        if sample < -32768: sample = -32768
+        step = step_table[index]
+        diff = sample - predictor
+        nibble = 0
+        if diff < 0:
+            nibble = 8
+            diff = -diff
+        if diff >= step:
+            nibble |= 4
+            diff -= step
+        if diff >= step >> 1:
+            nibble |= 2
+            diff -= step >> 1
+        if diff >= step >> 2:
+            nibble |= 1
+        diffq = step >> 3
+        if nibble & 4: diffq += step
+        if nibble & 2: diffq += step >> 1
+        if nibble & 1: diffq += step >> 2
+        if nibble & 8:
+            predictor -= diffq
+        else:
+            predictor += diffq
+        if predictor > 32767: predictor = 32767
+        if predictor < -32768: predictor = -32768
+        index += index_table[nibble]
+        if index < 0: index = 0
+        if index > 88: index = 88
+        if j & 1:
+            out[j >> 1] = low_nibble | (nibble << 4)
+        else:
+            low_nibble = nibble
+    return total >> 1
+
+
+_FFT_PLAN_CACHE = {}
+
+
+def _fft_plan(n):
+    # bit-reversal permutation and twiddle table for a power-of-two size, shared by
+    # all chains and computed only once per size
+    if n not in _FFT_PLAN_CACHE:
+        rev = np.zeros(n, dtype=np.int64)
+        bits = n.bit_length() - 1
+        for i in range(1, n):
+            rev[i] = (rev[i >> 1] >> 1) | ((i & 1) << (bits - 1))
+        k = np.arange(n // 2)
+        tw = np.exp(-2j * np.pi * k / n)
+        _FFT_PLAN_CACHE[n] = (rev, tw.real.astype(np.float32), tw.imag.astype(np.float32))
+    return _FFT_PLAN_CACHE[n]
+
+
+@_jit
+def _fft_radix2(re, im, rev, tw_re, tw_im):
+    # iterative decimation-in-time radix-2 fft over split re/im lanes; the twiddles
+    # come from the precomputed plan so the butterfly loops stay branch-free
+    n = re.shape[0]
+    for i in range(n):
+        j = rev[i]
+        if j > i:
+            tr = re[i]
+            re[i] = re[j]
+            re[j] = tr
+            ti = im[i]
+            im[i] = im[j]
+            im[j] = ti
+    size = 2
+    tw_step = n >> 1
+    while size <= n:
+        half = size >> 1
+        for start in range(0, n, size):
+            k = 0
+            for i in range(start, start + half):
+                wr = tw_re[k]
+                wi = tw_im[k]
+                j = i + half
+                xr = re[j] * wr - im[j] * wi
+                xi = re[j] * wi + im[j] * wr
+                re[j] = re[i] - xr
+                im[j] = im[i] - xi
+                re[i] += xr
+                im[i] += xi
+                k += tw_step
+        size <<= 1
+        tw_step >>= 1
+
+
+@_jit
+def _encode_ima_adpcm(samples, n, out, predictor, index, step_table, index_table):
+    # streaming ima adpcm for the audio path, matching encode_ima_adpcm_i16_u8: state is
+    # carried across blocks, two samples pack into one byte, low nibble first
+    for k in range(n >> 1):
+        low_nibble = 0
+        for half in range(2):
+            sample = samples[2 * k + half]
+            step = step_table[index]
+            diff = sample - predictor
+            nibble = 0
+            if diff < 0:
+                nibble = 8
+                diff = -diff
+            if diff >= step:
+                nibble |= 4
+                diff -= step
+            if diff >= step >> 1:
+                nibble |= 2
+                diff -= step >> 1
+            if diff >= step >> 2:
+                nibble |= 1
+            diffq = step >> 3
+            if nibble & 4: diffq += step
+            if nibble & 2: diffq += step >> 1
+            if nibble & 1: diffq += step >> 2
+            if nibble & 8:
+                predictor -= diffq
+            else:
+                predictor += diffq
+            if predictor > 32767: predictor = 32767
+            if predictor < -32768: predictor = -32768
+            index += index_table[nibble]
+            if index < 0: index = 0
+            if index > 88: index = 88
+            if half == 0:
+                low_nibble = nibble
+            else:
+                out[k] = low_nibble | (nibble << 4)
+    return predictor, index
+
+
+@_jit
+def _fmdemod(inp, n, last, out):
+    prev = last
+    for i in range(n):
+        cur = inp[i]
+        d = cur * prev.conjugate()
+        out[i] = math.atan2(d.imag, d.real) / math.pi
+        prev = cur
+    return prev
+
+
+@_jit
+def _fractional_decimate(inp, n, rate, pos, out):
+    k = 0
+    while pos < n - 1:
+        i = int(pos)
+        frac = pos - i
+        out[k] = inp[i] * (1.0 - frac) + inp[i + 1] * frac
+        k += 1
+        pos += rate
+    return k, pos
+
+
+@_jit
+def _deemphasis(buf, n, alpha, last):
+    for i in range(n):
+        last = last + alpha * (buf[i] - last)
+        buf[i] = last
+    return last
+
+
+@_jit
+def _simple_agc(buf, n, gain, rate, reference, max_gain):
+    for i in range(n):
+        absv = abs(buf[i])
+        ideal = reference / absv if absv > 1e-9 else max_gain
+        if ideal > max_gain:
+            ideal = max_gain
+        gain = (1.0 - rate) * gain + rate * ideal
+        buf[i] = buf[i] * gain
+    return gain
+
+
+def firdes_lowpass(cutoff, transition):
+    # hamming-windowed sinc, same design the csdr chain used
+    taps_length = int(round(4.0 / transition))
+    if taps_length < 9: taps_length = 9
+    taps_length |= 1
+    n = np.arange(taps_length) - (taps_length - 1) / 2.0
+    taps = np.sinc(2.0 * cutoff * n) * np.hamming(taps_length)
+    return (taps / np.sum(taps)).astype(np.float32)
+
+
+def firdes_bandpass(low, high, transition):
+    # lowpass prototype shifted up to the center of the passband
+    prototype = firdes_lowpass((high - low) / 2.0, transition).astype(np.float64)
+    n = np.arange(len(prototype)) - (len(prototype) - 1) / 2.0
+    return (prototype * np.exp(2j * np.pi * ((low + high) / 2.0) * n)).astype(np.complex64)
+
+
+class Buffer(object):
+    """
+    hands chunks from the dsp thread over to the output readers; read() blocks like the
+    subprocess stdout reads did, and returns the eof marker once the chain shuts down
+    """
+    def __init__(self, eof = b""):
+        self.eof = eof
+        self.cond = threading.Condition()
+        self.chunks = []
+        self.closed = False
+
+    def write(self, data):
+        with self.cond:
+            if self.closed: return
+            self.chunks.append(data)
+            self.cond.notify()
+
+    def read(self):
+        with self.cond:
+            while not self.chunks and not self.closed:
+                self.cond.wait()
+            if self.chunks:
+                return self.chunks.pop(0)
+            return self.eof
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+
+# converters from the native nmux formats to complex64, mirroring the csdr convert_*_f
+# conversions; keeping the socket stream narrow quarters (u8) or halves (s16) the bytes
+# moved per sample compared to a float stream
+
+def _iq_from_u8(data):
+    return ((np.frombuffer(data, dtype=np.uint8).astype(np.float32) - 127.4) / 128.0).view(np.complex64)
+
+
+def _iq_from_s8(data):
+    return (np.frombuffer(data, dtype=np.int8).astype(np.float32) / 128.0).view(np.complex64)
+
+
+def _iq_from_s16(data):
+    return (np.frombuffer(data, dtype=np.int16).astype(np.float32) / 32768.0).view(np.complex64)
+
+
+def _iq_from_f32(data):
+    return np.frombuffer(data, dtype=np.complex64)
+
+
+IQ_FORMATS = {
+    # format -> (bytes per complex sample, converter)
+    "u8": (2, _iq_from_u8),
+    "s8": (2, _iq_from_s8),
+    "s16": (4, _iq_from_s16),
+    "f32": (8, _iq_from_f32),
+}
+
+
+class InProcessChain(object):
+    """
+    base for the in-process dsp chains: owns the iq socket and the reader thread,
+    subclasses implement the actual processing and the outputs they feed
+    """
+    def __init__(self, dsp):
+        self.dsp = dsp
+        self.running = False
+        self.thread = None
+        self.socket = None
+        self.lock = threading.Lock()
+        (self.iq_sample_bytes, self.iq_converter) = IQ_FORMATS[dsp.nc_format]
+
+    def start(self):
+        # keep the jit cache in the same place the csdr plugin keeps its pipes
+        os.environ.setdefault("NUMBA_CACHE_DIR", self.dsp.temporary_directory)
+        self._setup()
+        self.socket = socket.create_connection(("127.0.0.1", self.dsp.nc_port))
+        self.running = True
+        self._add_outputs()
+        self.thread = threading.Thread(target = self._run)
+        self.thread.start()
+
+    def _run(self):
+        logger.debug("in-process chain %s started", type(self).__name__)
+        # with the pipe buffers gone the consumer thread is the only slack in the
+        # chain, so ask for realtime scheduling; needs CAP_SYS_NICE, fails quietly
+        try:
+            os.sched_setscheduler(0, os.SCHED_FIFO, os.sched_param(10))
+        except (OSError, AttributeError):
+            pass
+        leftover = b""
+        try:
+            while self.running:
+                data = self.socket.recv(CHUNK_SIZE)
+                if not data:
+                    break
+                if leftover:
+                    data = leftover + data
+                usable = len(data) - len(data) % self.iq_sample_bytes
+                leftover = data[usable:]
+                if usable:
+                    self._process(self.iq_converter(data[:usable]))
+        except OSError:
+            if self.running:
+                logger.exception("error reading from iq socket")
+        finally:
+            self._close_buffers()
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+            logger.debug("in-process chain %s shut down", type(self).__name__)
+
+    def stop(self):
+        self.running = False
+        if self.socket is not None:
+            try:
+                self.socket.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+        self._close_buffers()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout=1)
+
+
+class NumbaDspChain(InProcessChain):
+    """
+    in-process replacement for the analog demodulator pipelines of the csdr plugin. reads
+    iq directly from the nmux port and runs ddc shift, decimation, bandpass, squelch and
+    demodulation as jit-compiled kernels over preallocated numpy buffers, which avoids the
+    pipe copies and context switches of the subprocess chain. digital voice and digimode
+    chains still need the external binaries and keep using the subprocess path.
+    """
+
+    supported_demodulators = ["nfm", "am", "ssb"]
+
+    @staticmethod
+    def can_handle(dsp):
+        return available() \
+            and dsp.demodulator in NumbaDspChain.supported_demodulators \
+            and dsp.nc_format in IQ_FORMATS \
+            and dsp.secondary_demodulator is None \
+            and dsp.audio_compression in ("none", "adpcm") \
+            and not dsp.csdr_through and not dsp.csdr_dynamic_bufsize
+
+    def __init__(self, dsp):
+        super().__init__(dsp)
+        self.audio_compression = dsp.audio_compression
+        self.adpcm_predictor = 0
+        self.adpcm_index = 0
+        self.adpcm_carry = None
+        self.audio_buffer = Buffer(eof = b"")
+        self.smeter_buffer = Buffer(eof = None)
+        self.phase = 0.0
+        self.phase_inc = 0.0
+        self.ramp = None
+        self.ramp_inc = None
+        self.squelch_level = dsp.squelch_level
+        self.samp_rate = dsp.samp_rate
+        self.demodulator = dsp.demodulator
+        self.decimation = dsp.decimation
+        self.last_decimation = dsp.last_decimation
+        self.if_rate = dsp.if_samp_rate()
+        self.audio_rate = dsp.get_audio_rate()
+
+    def _setup(self):
+        self.taps_dec = firdes_lowpass(0.5 / self.decimation, self.dsp.ddc_transition_bw())
+        self.set_offset_freq(self.dsp.offset_freq)
+        self.set_bpf(self.dsp.low_cut, self.dsp.high_cut)
+
+        chunk_samples = CHUNK_SIZE // 8
+        self.if_buf = np.zeros(chunk_samples + len(self.taps_dec), dtype=np.complex64)
+        self.if_hist = 0
+        self.dec_out = np.empty(chunk_samples, dtype=np.complex64)
+        self.bpf_buf = np.zeros(chunk_samples, dtype=np.complex64)
+        self.bpf_hist = 0
+        self.bpf_out = np.empty(chunk_samples, dtype=np.complex64)
+        self.demod_out = np.empty(chunk_samples, dtype=np.float32)
+        self.audio_out = np.empty(chunk_samples, dtype=np.float32)
+
+        self.last_iq = complex(0.0, 0.0)
+        self.frac_pos = 0.0
+        self.frac_last = np.zeros(1, dtype=np.float32)
+        self.deemph_last = 0.0
+        self.deemph_alpha = 1.0 - math.exp(-1.0 / (self.audio_rate * 75e-6))
+        self.agc_gain = 1.0
+        self.dc_avg = 0.0
+        self.smeter_countdown = int(self.if_rate / 6)
+        self.squelch_open = True
+
+        # pick the jitted kernels when numba is around, the vectorized numpy versions
+        # otherwise. the sample-serial audio-rate stages (deemphasis, agc) stay as plain
+        # loops either way; at 11 kHz they are cheap even without numba.
+        if njit is not None:
+            self.fir_decimate = _fir_decimate_cc
+            self.fir = _fir_cc
+            self.fmdemod = _fmdemod
+            self.fractional_decimate = _fractional_decimate
+        else:
+            self.fir_decimate = _fir_decimate_cc_numpy
+            self.fir = _fir_cc_numpy
+            self.fmdemod = _fmdemod_numpy
+            self.fractional_decimate = _fractional_decimate_numpy
+
+    def _add_outputs(self):
+        self.dsp.output.add_output("audio", self.audio_buffer.read)
+        self.dsp.output.add_output("smeter", self.smeter_buffer.read)
+
+    def _close_buffers(self):
+        self.audio_buffer.close()
+        self.smeter_buffer.close()
+
+    def set_offset_freq(self, offset_freq):
+        with self.lock:
+            self.phase_inc = -2.0 * math.pi * float(offset_freq) / self.samp_rate
+
+    def set_bpf(self, low_cut, high_cut):
+        taps = firdes_bandpass(
+            float(low_cut) / self.if_rate,
+            float(high_cut) / self.if_rate,
+            float(self.dsp.bpf_transition_bw) / self.if_rate
+        )
+        with self.lock:
+            self.taps_bpf = taps
+            # filter length may have changed; the short transient on refill is no worse
+            # than what the subprocess chain produced on a bandwidth change
+            self.bpf_hist = 0
+
+    def set_squelch_level(self, squelch_level):
+        with self.lock:
+            self.squelch_level = squelch_level
+
+    def _shift(self, samples):
+        # ddc shift as one vectorized complex multiply. the unit rotator ramp only
+        # depends on phase_inc, so it is reused across blocks until the offset changes;
+        # only the start phase is applied as a scalar factor per block.
+        n = len(samples)
+        if self.ramp is None or self.ramp_inc != self.phase_inc or len(self.ramp) < n:
+            self.ramp = np.exp(1j * self.phase_inc * np.arange(max(n, CHUNK_SIZE // 8))).astype(np.complex64)
+            self.ramp_inc = self.phase_inc
+        shifted = samples * (self.ramp[:n] * np.complex64(complex(math.cos(self.phase), math.sin(self.phase))))
+        self.phase = math.fmod(self.phase + self.phase_inc * n, 2.0 * math.pi)
+        return shifted
+
+    def _process(self, samples):
+        with self.lock:
+            n = len(samples)
+            samples = self._shift(samples)
+            if self.if_hist + n > len(self.if_buf):
+                grown = np.zeros(self.if_hist + n + len(self.taps_dec), dtype=np.complex64)
+                grown[:self.if_hist] = self.if_buf[:self.if_hist]
+                self.if_buf = grown
+                self.dec_out = np.empty(len(self.if_buf), dtype=np.complex64)
+            self.if_buf[self.if_hist:self.if_hist + n] = samples
+            n_dec = self.fir_decimate(
+                self.if_buf, self.if_hist + n, self.taps_dec, self.decimation, self.dec_out
+            )
+            total = self.if_hist + n
+            consumed = n_dec * self.decimation
+            self.if_buf[:total - consumed] = self.if_buf[consumed:total]
+            self.if_hist = total - consumed
+            if n_dec == 0:
+                return
+
+            if self.bpf_hist + n_dec > len(self.bpf_buf):
+                grown = np.zeros(self.bpf_hist + n_dec + len(self.taps_bpf), dtype=np.complex64)
+                grown[:self.bpf_hist] = self.bpf_buf[:self.bpf_hist]
+                self.bpf_buf = grown
+                self.bpf_out = np.empty(len(self.bpf_buf), dtype=np.complex64)
+            self.bpf_buf[self.bpf_hist:self.bpf_hist + n_dec] = self.dec_out[:n_dec]
+            n_bpf = self.fir(self.bpf_buf, self.bpf_hist + n_dec, self.taps_bpf, self.bpf_out)
+            total = self.bpf_hist + n_dec
+            self.bpf_buf[:total - n_bpf] = self.bpf_buf[n_bpf:total]
+            self.bpf_hist = total - n_bpf
+            if n_bpf == 0:
+                return
+            iq = self.bpf_out[:n_bpf]
+
+            power = float(np.mean(iq.real * iq.real + iq.imag * iq.imag))
+            self.smeter_countdown -= n_bpf
+            if self.smeter_countdown <= 0:
+                self.smeter_countdown = int(self.if_rate / 6)
+                self.smeter_buffer.write(power)
+            self.squelch_open = self.squelch_level == 0 or power >= self.squelch_level
+
+        audio = self._demodulate(iq, n_bpf)
+        if audio is None:
+            return
+        if not self.squelch_open:
+            audio = np.zeros(len(audio), dtype=np.float32)
+        np.clip(audio, -1.0, 1.0, out=audio)
+        pcm = (audio * 32767.0).astype(np.int16)
+        if self.audio_compression == "adpcm":
+            data = self._encode_adpcm(pcm)
+            if data is None:
+                return
+            self.audio_buffer.write(data)
+        else:
+            self.audio_buffer.write(pcm.tobytes())
+
+    def _encode_adpcm(self, pcm):
+        samples = pcm.astype(np.int32)
+        if self.adpcm_carry is not None:
+            samples = np.concatenate((self.adpcm_carry, samples))
+        # the encoder packs sample pairs; an odd trailing sample carries over
+        n = len(samples) & ~1
+        self.adpcm_carry = samples[n:].copy() if len(samples) > n else None
+        if n == 0:
+            return None
+        out = np.empty(n >> 1, dtype=np.uint8)
+        (self.adpcm_predictor, self.adpcm_index) = _encode_ima_adpcm(
+            samples, n, out, self.adpcm_predictor, self.adpcm_index,
+            _ADPCM_STEP_TABLE, _ADPCM_INDEX_TABLE
+        )
+        return out.tobytes()
+
+    def _demodulate(self, iq, n):
+        if self.demodulator == "nfm":
+            self.last_iq = self.fmdemod(iq, n, self.last_iq, self.demod_out)
+            audio = self._last_decimate(self.demod_out, n)
+            if audio is None: return None
+            self.deemph_last = _deemphasis(audio, len(audio), self.deemph_alpha, self.deemph_last)
+            return audio
+        elif self.demodulator == "am":
+            demod = self.demod_out[:n]
+            np.sqrt(iq.real * iq.real + iq.imag * iq.imag, out=demod)
+            # dc block with a slowly tracking average, like csdr fastdcblock_ff
+            self.dc_avg = 0.999 * self.dc_avg + 0.001 * float(np.mean(demod))
+            demod -= self.dc_avg
+            audio = self._last_decimate(demod, n)
+            if audio is None: return None
+            self.agc_gain = _simple_agc(audio, len(audio), self.agc_gain, 0.0001, 0.8, 1000.0)
+            return audio
+        elif self.demodulator == "ssb":
+            np.copyto(self.demod_out[:n], iq.real)
+            audio = self._last_decimate(self.demod_out[:n], n)
+            if audio is None: return None
+            self.agc_gain = _simple_agc(audio, len(audio), self.agc_gain, 0.0001, 0.8, 1000.0)
+            return audio
+        return None
+
+    def _last_decimate(self, samples, n):
+        if self.last_decimation == 1.0:
+            return samples[:n].copy()
+        # keep one sample of history for the interpolation across block boundaries
+        buf = np.concatenate((self.frac_last, samples[:n]))
+        k, pos = self.fractional_decimate(buf, len(buf), self.last_decimation, self.frac_pos, self.audio_out)
+        self.frac_pos = pos - (len(buf) - 1)
+        self.frac_last[0] = buf[-1]
+        if k == 0: return None
+        return self.audio_out[:k].copy()
+
+
+class NumbaFftChain(InProcessChain):
+    """
+    in-process spectrum chain replacing the csdr fft_cc | logaveragepower_cf |
+    fft_exchange_sides_ff pipeline. the fft output is deinterleaved once into split
+    real/imaginary lanes, so power accumulation, averaging, log conversion and the
+    half-swap all run over contiguous real-only arrays in a single pass.
+    """
+
+    @staticmethod
+    def can_handle(dsp):
+        return available() \
+            and dsp.demodulator == "fft" \
+            and dsp.nc_format in IQ_FORMATS \
+            and not dsp.csdr_through and not dsp.csdr_dynamic_bufsize
+
+    def __init__(self, dsp):
+        super().__init__(dsp)
+        self.fft_size = dsp.fft_size
+        self.fft_averages = dsp.fft_averages
+        self.fft_compression = dsp.fft_compression
+        self.block_size = int(dsp.fft_block_size())
+        self.output_buffer = Buffer(eof = b"")
+
+    def _setup(self):
+        n = self.fft_size
+        self.window = np.hamming(n).astype(np.float32)
+        self.window_buf = np.zeros(n, dtype=np.complex64)
+        self.power_accum = np.zeros(n, dtype=np.float32)
+        self.n_avg = 0
+        self.since_last_fft = 0
+        # power-of-two sizes go through the jitted radix-2 codelet with a precomputed
+        # plan; everything else falls back to np.fft
+        self.fft_plan = _fft_plan(n) if njit is not None and n >= 2 and n & (n - 1) == 0 else None
+
+    def _add_outputs(self):
+        self.dsp.output.add_output("audio", self.output_buffer.read)
+
+    def _close_buffers(self):
+        self.output_buffer.close()
+
+    def _process(self, samples):
+        pos = 0
+        n = self.fft_size
+        while pos < len(samples):
+            take = min(len(samples) - pos, self.block_size - self.since_last_fft)
+            chunk = samples[pos:pos + take]
+            # slide the fft window; blocks larger than the fft just drop the overhang
+            if take >= n:
+                self.window_buf[:] = chunk[-n:]
+            else:
+                self.window_buf[:-take] = self.window_buf[take:]
+                self.window_buf[-take:] = chunk
+            pos += take
+            self.since_last_fft += take
+            if self.since_last_fft >= self.block_size:
+                self.since_last_fft = 0
+                self._fft()
+
+    def _fft_transform(self, windowed):
+        # returns the spectrum as split re/im lanes; power accumulation downstream only
+        # ever touches real-valued arrays
+        if self.fft_plan is not None:
+            lanes = windowed.view(np.float32)
+            re = np.ascontiguousarray(lanes[0::2])
+            im = np.ascontiguousarray(lanes[1::2])
+            (rev, tw_re, tw_im) = self.fft_plan
+            _fft_radix2(re, im, rev, tw_re, tw_im)
+            return (re, im)
+        spectrum = np.fft.fft(windowed).astype(np.complex64)
+        lanes = spectrum.view(np.float32).reshape(-1, 2).T
+        return (lanes[0], lanes[1])
+
+    def _fft(self):
+        (re, im) = self._fft_transform(self.window_buf * self.window)
+        self.power_accum += re * re + im * im
+        self.n_avg += 1
+        if self.n_avg >= max(self.fft_averages, 1):
+            if self.fft_compression == "adpcm":
+                out = np.empty((self.fft_size + COMPRESS_FFT_PAD_N) // 2, dtype=np.uint8)
+                _fft_compress_adpcm(
+                    self.power_accum, self.n_avg, COMPRESS_FFT_PAD_N, out,
+                    _ADPCM_STEP_TABLE, _ADPCM_INDEX_TABLE
+                )
+                self.output_buffer.write(out.tobytes())
+            else:
+                out = np.empty(self.fft_size, dtype=np.float32)
+                half = self.fft_size // 2
+                # average, convert to dB and exchange the sides in the same pass
+                db = 10.0 * np.log10(self.power_accum / self.n_avg + 1e-20) - 70.0
+                out[:half] = db[half:]
+                out[half:] = db[:half]
+                self.output_buffer.write(out.tobytes())
+            self.power_accum[:] = 0.0
+            self.n_avg = 0
+
+
+def create_chain(dsp):
+    # factory used by csdr.dsp to find an in-process replacement for the subprocess chain
+    for cls in [NumbaFftChain, NumbaDspChain]:
+        if cls.can_handle(dsp):
+            return cls(dsp)
+    return None
@@ -1,6 +1,7 @@
 import os
 import mimetypes
 import json
+import hashlib
 from datetime import datetime
 from string import Template
 from owrx.websocket import WebSocketConnection
@@ -17,7 +18,7 @@ class Controller(object):
     def __init__(self, handler, request):
         self.handler = handler
         self.request = request
-    def send_response(self, content, code = 200, content_type = "text/html", last_modified: datetime = None, max_age = None):
+    def send_response(self, content, code = 200, content_type = "text/html", last_modified: datetime = None, max_age = None, etag = None):
         self.handler.send_response(code)
         if content_type is not None:
             self.handler.send_header("Content-Type", content_type)
@@ -25,6 +26,8 @@ class Controller(object):
             self.handler.send_header("Last-Modified", last_modified.strftime("%a, %d %b %Y %H:%M:%S GMT"))
         if max_age is not None:
             self.handler.send_header("Cache-Control", "max-age: {0}".format(max_age))
+        if etag is not None:
+            self.handler.send_header("ETag", etag)
         self.handler.end_headers()
         if (type(content) == str):
             content = content.encode()
@@ -61,12 +64,35 @@ class AssetsController(Controller):
                     return
 
             f = open('htdocs/' + file, 'rb')
-            data = f.read()
-            f.close()
 
             if content_type is None:
-                (content_type, encoding) = mimetypes.MimeTypes().guess_type(file)
-            self.send_response(data, content_type = content_type, last_modified = modified, max_age = 3600)
+                # the module-level database is initialized once; instantiating MimeTypes
+                # here re-read the system mime files on every asset request
+                (content_type, encoding) = mimetypes.guess_type(file)
+
+            size = os.fstat(f.fileno()).st_size
+            self.handler.send_response(200)
+            if content_type is not None:
+                self.handler.send_header("Content-Type", content_type)
+            self.handler.send_header("Last-Modified", modified.strftime("%a, %d %b %Y %H:%M:%S GMT"))
+            self.handler.send_header("Cache-Control", "max-age: {0}".format(3600))
+            self.handler.send_header("Content-Length", size)
+            self.handler.end_headers()
+            self.handler.wfile.flush()
+
+            # hand the file to the socket without copying it through userspace; falls
+            # back to a plain copy where sendfile is not available
+            offset = 0
+            try:
+                while offset < size:
+                    sent = os.sendfile(self.handler.connection.fileno(), f.fileno(), offset, size - offset)
+                    if sent == 0:
+                        break
+                    offset += sent
+            except OSError:
+                f.seek(offset)
+                self.handler.wfile.write(f.read())
+            f.close()
         except FileNotFoundError:
             self.send_response("file not found", code = 404)
     def handle_request(self):
@@ -74,12 +100,22 @@ class AssetsController(Controller):
         self.serve_file(filename)
 
 class TemplateController(Controller):
-    def render_template(self, file, **vars):
-        f = open('htdocs/' + file, 'r')
-        template = Template(f.read())
-        f.close()
+    # parsed templates shared by all requests, invalidated when the file changes on disk
+    template_cache = {}
+
+    def get_template(self, file):
+        path = 'htdocs/' + file
+        mtime = os.path.getmtime(path)
+        cached = TemplateController.template_cache.get(file)
+        if cached is None or cached[0] != mtime:
+            f = open(path, 'r')
+            cached = (mtime, Template(f.read()))
+            f.close()
+            TemplateController.template_cache[file] = cached
+        return cached[1]
 
-        return template.safe_substitute(**vars)
+    def render_template(self, file, **vars):
+        return self.get_template(file).safe_substitute(**vars)
 
     def serve_template(self, file, **vars):
         self.send_response(self.render_template(file, **vars), content_type = 'text/html')
@@ -109,9 +145,20 @@ class FeatureController(WebpageController):
         self.serve_template("features.html", **self.template_variables())
 
 class ApiController(Controller):
+    # feature availability does not change while the process is running, so the report
+    # is serialized once on first request; the etag lets browsers revalidate with a 304
+    feature_cache = None
+
     def handle_request(self):
-        data = json.dumps(FeatureDetector().feature_report())
-        self.send_response(data, content_type = "application/json")
+        if ApiController.feature_cache is None:
+            data = json.dumps(FeatureDetector().feature_report()).encode()
+            etag = "\"{0}\"".format(hashlib.blake2b(data, digest_size = 12).hexdigest())
+            ApiController.feature_cache = (data, etag)
+        (data, etag) = ApiController.feature_cache
+        if self.handler.headers.get("If-None-Match") == etag:
+            self.send_response(b"", code = 304)
+            return
+        self.send_response(data, content_type = "application/json", etag = etag)
 
 class WebSocketController(Controller):
     def handle_request(self):
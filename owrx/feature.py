@@ -16,7 +16,7 @@ class UnknownFeatureException(Exception):
 
 class FeatureDetector(object):
     features = {
-        "core": [ "csdr", "nmux", "nc" ],
+        "core": [ "csdr", "nmux" ],
         "rtl_sdr": [ "rtl_sdr" ],
         "sdrplay": [ "rx_tools" ],
         "hackrf": [ "hackrf_transfer" ],
@@ -97,13 +97,6 @@ class FeatureDetector(object):
         """
         return self.command_is_runnable("nmux --help")
 
-    def has_nc(self):
-        """
-        Nc is the client used to connect to the nmux multiplexer. It is provided by either the BSD netcat (recommended
-        for better performance) or GNU netcat packages. Please check your distribution package manager for options.
-        """
-        return self.command_is_runnable('nc --help')
-
     def has_rtl_sdr(self):
         """
         The rtl-sdr command is required to read I/Q data from an RTL SDR USB-Stick. It is available in most
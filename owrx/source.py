@@ -102,6 +102,10 @@ class SdrSource(object):
     def getFormatConversion(self):
         return None
 
+    # the sample format the command delivers; override in subclasses, if necessary
+    def getFormat(self):
+        return "f32"
+
     def activateProfile(self, id = None):
         profiles = self.props["profiles"]
         if id is None:
@@ -137,10 +141,9 @@ class SdrSource(object):
             **props.collect("samp_rate", "center_freq", "ppm", "rf_gain", "lna_gain", "rf_amp", "antenna", "if_gain").__dict__()
         )
 
-        format_conversion = self.getFormatConversion()
-        if format_conversion is not None:
-            start_sdr_command += " | " + format_conversion
-
+        # the iq stream stays in the device's native format through nmux and the client
+        # sockets; the dsp chains convert on their side. this cuts the bytes moved per
+        # sample to a quarter (u8 devices) or half (s16) of the old float stream.
         nmux_bufcnt = nmux_bufsize = 0
         while nmux_bufsize < props["samp_rate"]/4: nmux_bufsize += 4096
         while nmux_bufsize * nmux_bufcnt < props["nmux_memory"] * 1e6: nmux_bufcnt += 1
@@ -236,6 +239,9 @@ class RtlSdrSource(SdrSource):
     def getFormatConversion(self):
         return "csdr convert_u8_f"
 
+    def getFormat(self):
+        return "u8"
+
 class HackrfSource(SdrSource):
     def getCommand(self):
         return "hackrf_transfer -s {samp_rate} -f {center_freq} -g {rf_gain} -l{lna_gain} -a{rf_amp} -r-"
@@ -243,6 +249,9 @@ class HackrfSource(SdrSource):
     def getFormatConversion(self):
         return "csdr convert_s8_f"
 
+    def getFormat(self):
+        return "s8"
+
 class SdrplaySource(SdrSource):
     def getCommand(self):
         command = "rx_sdr -F CF32 -s {samp_rate} -f {center_freq} -p {ppm}"
@@ -267,6 +276,8 @@ class AirspySource(SdrSource):
         return command
     def getFormatConversion(self):
         return "csdr convert_s16_f"
+    def getFormat(self):
+        return "s16"
 
 class SpectrumThread(csdr.output):
     def __init__(self, sdrSource):
@@ -280,6 +291,7 @@ class SpectrumThread(csdr.output):
 
         self.dsp = dsp = csdr.dsp(self)
         dsp.nc_port = self.sdrSource.getPort()
+        dsp.nc_format = self.sdrSource.getFormat()
         dsp.set_demodulator("fft")
 
         def set_fft_averages(key, value):
@@ -358,6 +370,7 @@ class DspManager(csdr.output):
 
         self.dsp = csdr.dsp(self)
         self.dsp.nc_port = self.sdrSource.getPort()
+        self.dsp.nc_format = self.sdrSource.getFormat()
 
         def set_low_cut(cut):
             bpf = self.dsp.get_bpf()
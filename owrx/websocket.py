@@ -1,75 +1,151 @@
 import base64
 import hashlib
 import json
+import struct
 
 import logging
 logger = logging.getLogger(__name__)
 
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+def _apply_mask_fallback(data, masking_key):
+    length = len(data)
+    if length == 0:
+        return data
+    if np is not None and length >= 4096:
+        # large binary frames go through numpy, whose xor loop is vectorized; the
+        # bigint path below wins on small frames where the array setup dominates
+        arr = np.frombuffer(data, dtype=np.uint8)
+        out = np.empty(length, dtype=np.uint8)
+        n4 = length & ~3
+        mask_word = np.frombuffer(masking_key, dtype=np.uint32)[0]
+        np.bitwise_xor(arr[:n4].view(np.uint32), mask_word, out=out[:n4].view(np.uint32))
+        for i in range(n4, length):
+            out[i] = data[i] ^ masking_key[i & 3]
+        return out.tobytes()
+    # repeat the mask over the payload length and let the int implementation run
+    # the xor in one go instead of looping over the bytes in the interpreter
+    mask_int = int.from_bytes(masking_key * ((length + 3) // 4), "big") >> (8 * ((-length) % 4))
+    return (int.from_bytes(data, "big") ^ mask_int).to_bytes(length, "big")
+
+
+try:
+    # optional C masking implementation (xors a machine word at a time); the pure
+    # python fallback keeps everything working without it
+    from wsaccel.xormask import XorMaskerSimple
+
+    def _apply_mask(data, masking_key):
+        return XorMaskerSimple(masking_key).process(data)
+except ImportError:
+    _apply_mask = _apply_mask_fallback
+
+
+# the one-shot sha1 in the handshake dispatches to openssl (with its hardware sha
+# instructions) when cpython is linked against it; leave a hint when it is not
+try:
+    import _hashlib
+except ImportError:
+    _hashlib = None
+if _hashlib is None or not hasattr(_hashlib, "openssl_sha1"):
+    logger.info("hashlib is not backed by openssl; handshakes will use the slower builtin sha1")
+
+# handshake constants: the protocol guid from RFC 6455 and the complete response,
+# both prebuilt as bytes so a new connection only fills in the accept value
+_WS_GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+_WS_RESPONSE = b"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: %b\r\nCQ-CQ-de: HA5KFU\r\n\r\n"
+
+# reusable encoder for dict sends: configured once, and the compact separators keep
+# the high-rate metadata messages a bit smaller on the wire.
+# allow_nan = False disallows NaN and Infinity to be encoded. Browser JSON will not parse them anyway.
+_json_encode = json.JSONEncoder(allow_nan = False, separators = (",", ":")).encode
+
+# frame header layouts, compiled once; see get_header
+_HEADER_SHORT = struct.Struct(">BB")
+_HEADER_EXTENDED = struct.Struct(">BBH")
+_HEADER_LONG = struct.Struct(">BBQ")
+
+# every possible header for short binary frames, plus the close frame; these come up
+# often enough (smeter updates, teardown storms) to be worth the 126 small constants
+_BINARY_HEADERS = [_HEADER_SHORT.pack(0b10000010, size) for size in range(126)]
+_CLOSE_FRAME = _HEADER_SHORT.pack(0b10001000, 0)
+
+
 class WebSocketConnection(object):
     def __init__(self, handler, messageHandler):
         self.handler = handler
         self.messageHandler = messageHandler
-        my_headers = self.handler.headers.items()
-        my_header_keys = list(map(lambda x:x[0],my_headers))
-        h_key_exists = lambda x:my_header_keys.count(x)
-        h_value = lambda x:my_headers[my_header_keys.index(x)][1]
-        if (not h_key_exists("Upgrade")) or not (h_value("Upgrade")=="websocket") or (not h_key_exists("Sec-WebSocket-Key")):
+        # the headers object is already a case-insensitive mapping; no need to rebuild
+        # it as lists and scan those
+        headers = self.handler.headers
+        ws_key = headers.get("Sec-WebSocket-Key")
+        if headers.get("Upgrade") != "websocket" or ws_key is None:
             raise WebSocketException
-        ws_key = h_value("Sec-WebSocket-Key")
-        shakey = hashlib.sha1()
-        shakey.update("{ws_key}258EAFA5-E914-47DA-95CA-C5AB0DC85B11".format(ws_key = ws_key).encode())
-        ws_key_toreturn = base64.b64encode(shakey.digest())
-        self.handler.wfile.write("HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {0}\r\nCQ-CQ-de: HA5KFU\r\n\r\n".format(ws_key_toreturn.decode()).encode())
+        accept = base64.b64encode(hashlib.sha1(ws_key.encode("ascii") + _WS_GUID).digest())
+        self.handler.wfile.write(_WS_RESPONSE % accept)
 
     def get_header(self, size, opcode):
         ws_first_byte = 0b10000000 | (opcode & 0x0F)
         if (size > 2**16 - 1):
             # frame size can be increased up to 2^64 by setting the size to 127
             # anything beyond that would need to be segmented into frames. i don't really think we'll need more.
-            return bytes([
-                ws_first_byte,
-                127,
-                (size >> 56) & 0xff,
-                (size >> 48) & 0xff,
-                (size >> 40) & 0xff,
-                (size >> 32) & 0xff,
-                (size >> 24) & 0xff,
-                (size >> 16) & 0xff,
-                (size >> 8) & 0xff,
-                size & 0xff
-            ])
+            return _HEADER_LONG.pack(ws_first_byte, 127, size)
         elif (size > 125):
             # up to 2^16 can be sent using the extended payload size field by putting the size to 126
-            return bytes([
-                ws_first_byte,
-                126,
-                (size >> 8) & 0xff,
-                size & 0xff
-            ])
+            return _HEADER_EXTENDED.pack(ws_first_byte, 126, size)
+        elif (ws_first_byte == 0b10000010):
+            # short binary frames get their header from the precomputed table
+            return _BINARY_HEADERS[size]
         else:
             # 125 bytes binary message in a single unmasked frame
-            return bytes([ws_first_byte, size])
+            return _HEADER_SHORT.pack(ws_first_byte, size)
 
     def send(self, data):
-        # convenience
-        if (type(data) == dict):
-            # allow_nan = False disallows NaN and Infinty to be encoded. Browser JSON will not parse them anyway.
-            data = json.dumps(data, allow_nan = False)
-
+        # convenience dispatch; the binary path comes first since it is the hot one.
+        # callers that know their payload type can use the send_* methods directly.
+        if isinstance(data, (bytes, bytearray, memoryview)):
+            self.send_binary(data)
         # string-type messages are sent as text frames
-        if (type(data) == str):
-            header = self.get_header(len(data), 1)
-            data_to_send = header + data.encode('utf-8')
-        # anything else as binary
+        elif isinstance(data, str):
+            self.send_text(data)
         else:
-            header = self.get_header(len(data), 2)
-            data_to_send = header + data
-        written = self.handler.wfile.write(data_to_send)
-        if (written != len(data_to_send)):
-            logger.error("incomplete write! closing socket!")
-            self.close()
+            self.send_json(data)
+
+    def send_json(self, data):
+        self.send_text(_json_encode(data))
+
+    def send_text(self, data):
+        payload = data.encode('utf-8')
+        self._write_frame(self.get_header(len(payload), 1), payload)
+
+    def send_binary(self, data):
+        self._write_frame(self.get_header(len(data), 2), data)
+
+    def _write_frame(self, header, payload):
+        sock = self.handler.connection
+        if hasattr(sock, "sendmsg"):
+            # scatter-gather send: header and payload go out in one syscall without
+            # being copied into a joined buffer first
+            sent = sock.sendmsg([header, payload])
+            total = len(header) + len(payload)
+            # blocking sockets can still send short when interrupted; finish the rest
+            while sent < total:
+                if sent >= len(header):
+                    sock.sendall(memoryview(payload)[sent - len(header):])
+                    break
+                sent += sock.sendmsg([memoryview(header)[sent:], payload])
         else:
-            self.handler.wfile.flush()
+            data_to_send = header + payload
+            written = self.handler.wfile.write(data_to_send)
+            if (written != len(data_to_send)):
+                logger.error("incomplete write! closing socket!")
+                self.close()
+            else:
+                self.handler.wfile.flush()
 
     def read_loop(self):
         open = True
@@ -79,13 +155,19 @@ class WebSocketConnection(object):
             length = header[1] & 0x7F
             mask = (header[1] & 0x80) >> 7
             if (length == 126):
-                header = self.handler.rfile.read(2)
-                length = (header[0] << 8) + header[1]
-            if (mask):
-                masking_key = self.handler.rfile.read(4)
-            data = self.handler.rfile.read(length)
+                # extended length and masking key come in a single read
+                extra = self.handler.rfile.read(2 + 4 * mask)
+                length = (extra[0] << 8) + extra[1]
+                masking_key = extra[2:]
+                data = self.handler.rfile.read(length)
+            else:
+                # short frame: masking key and payload come in a single read
+                data = self.handler.rfile.read(4 * mask + length)
+                masking_key = data[:4]
+                if (mask):
+                    data = data[4:]
             if (mask):
-                data = bytes([b ^ masking_key[index % 4] for (index, b) in enumerate(data)])
+                data = _apply_mask(data, masking_key)
             if (opcode == 1):
                 message = data.decode('utf-8')
                 self.messageHandler.handleTextMessage(self, message)
@@ -99,8 +181,7 @@ class WebSocketConnection(object):
 
     def close(self):
         try:
-            header = self.get_header(0, 8)
-            self.handler.wfile.write(header)
+            self.handler.wfile.write(_CLOSE_FRAME)
             self.handler.wfile.flush()
         except ValueError:
             logger.exception("ValueError while writing close frame:")
@@ -2,10 +2,11 @@ import threading
 import wave
 from datetime import datetime, timedelta, date, timezone
 import time
-import sched
 import subprocess
 import os
-from multiprocessing.connection import Pipe
+from queue import SimpleQueue
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from owrx.map import Map, LocatorLocation
 import re
 from owrx.config import PropertyManager
@@ -16,14 +17,27 @@ logger = logging.getLogger(__name__)
 
 
 class WsjtChopper(threading.Thread):
+    # all choppers share one bounded pool, so a decode backlog cannot spawn an
+    # unbounded number of threads
+    decoderPool = ThreadPoolExecutor(max_workers = os.cpu_count() or 2)
+
     def __init__(self, source):
         self.source = source
         self.tmp_dir = PropertyManager.getSharedInstance()["temporary_directory"]
+        # the capture files only live for one decoding cycle; on linux /dev/shm keeps
+        # them off the disk entirely. a temporary_directory configured to something
+        # other than the default is respected.
+        if self.tmp_dir == "/tmp" and os.path.isdir("/dev/shm") and os.access("/dev/shm", os.W_OK):
+            self.tmp_dir = "/dev/shm"
         (self.wavefilename, self.wavefile) = self.getWaveFile()
         self.switchingLock = threading.Lock()
-        self.scheduler = sched.scheduler(time.time, time.sleep)
-        self.fileQueue = []
-        (self.outputReader, self.outputWriter) = Pipe()
+        self.switcherStop = threading.Event()
+        # fifo: the oldest capture decodes first, and deque pops are atomic between
+        # the switcher and the ingest thread
+        self.fileQueue = deque()
+        # decoder output lines pass through an in-process queue; a multiprocessing
+        # Pipe would pickle every line on both ends for nothing
+        self.outputQueue = SimpleQueue()
         self.doRun = True
         super().__init__()
 
@@ -49,15 +63,16 @@ class WsjtChopper(threading.Thread):
         return t.timestamp()
 
     def startScheduler(self):
-        self._scheduleNextSwitch()
-        threading.Thread(target = self.scheduler.run).start()
+        threading.Thread(target = self.switchLoop).start()
 
     def emptyScheduler(self):
-        for event in self.scheduler.queue:
-            self.scheduler.cancel(event)
+        self.switcherStop.set()
 
-    def _scheduleNextSwitch(self):
-        self.scheduler.enterabs(self.getNextDecodingTime(), 1, self.switchFiles)
+    def switchLoop(self):
+        # one long-lived thread waits out each decoding interval; wait() doubles as
+        # the shutdown signal, so no thread is spawned per switch
+        while not self.switcherStop.wait(max(0, self.getNextDecodingTime() - time.time())):
+            self.switchFiles()
 
     def switchFiles(self):
         self.switchingLock.acquire()
@@ -68,7 +83,6 @@ class WsjtChopper(threading.Thread):
 
         file.close()
         self.fileQueue.append(filename)
-        self._scheduleNextSwitch()
 
     def decoder_commandline(self, file):
         """
@@ -79,39 +93,40 @@ class WsjtChopper(threading.Thread):
     def decode(self):
         def decode_and_unlink(file):
             decoder = subprocess.Popen(self.decoder_commandline(file), stdout=subprocess.PIPE, cwd=self.tmp_dir)
-            while True:
-                line = decoder.stdout.readline()
-                if line is None or (isinstance(line, bytes) and len(line) == 0):
-                    break
-                self.outputWriter.send(line)
+            # iterating the buffered pipe splits lines without a read call per line
+            for line in decoder.stdout:
+                self.outputQueue.put(line)
             rc = decoder.wait()
             logger.debug("decoder return code: %i", rc)
             os.unlink(file)
 
-            self.decoder = decoder
-
-        if self.fileQueue:
-            file = self.fileQueue.pop()
-            logger.debug("processing file {0}".format(file))
-            threading.Thread(target=decode_and_unlink, args=[file]).start()
+        try:
+            file = self.fileQueue.popleft()
+        except IndexError:
+            return
+        logger.debug("processing file {0}".format(file))
+        WsjtChopper.decoderPool.submit(decode_and_unlink, file)
 
     def run(self) -> None:
         logger.debug("WSJT chopper starting up")
         self.startScheduler()
         while self.doRun:
-            data = self.source.read(256)
+            # a batch of this size is still only ~170ms of audio at 12kHz, but it cuts
+            # the per-iteration call and locking overhead to a sixteenth
+            data = self.source.read(4096)
             if data is None or (isinstance(data, bytes) and len(data) == 0):
                 logger.warning("zero read on WSJT chopper")
                 self.doRun = False
             else:
                 self.switchingLock.acquire()
-                self.wavefile.writeframes(data)
+                # writeframes() seeks back and patches the riff header on every call;
+                # the raw variant skips that, and close() in switchFiles patches once
+                self.wavefile.writeframesraw(data)
                 self.switchingLock.release()
 
             self.decode()
         logger.debug("WSJT chopper shutting down")
-        self.outputReader.close()
-        self.outputWriter.close()
+        self.outputQueue.put(None)
         self.emptyScheduler()
         try:
             os.unlink(self.wavefilename)
@@ -119,10 +134,8 @@ class WsjtChopper(threading.Thread):
             logger.exception("error removing undecoded file")
 
     def read(self):
-        try:
-            return self.outputReader.recv()
-        except EOFError:
-            return None
+        # returns None once the chopper has shut down
+        return self.outputQueue.get()
 
 
 class Ft8Chopper(WsjtChopper):
@@ -181,8 +194,8 @@ class Ft4Chopper(WsjtChopper):
 
 
 class WsjtParser(object):
-    locator_pattern = re.compile(".*\\s([A-Z0-9]+)\\s([A-R]{2}[0-9]{2})$")
-    wspr_splitter_pattern = re.compile("([A-Z0-9]*)\\s([A-R]{2}[0-9]{2})\\s([0-9]+)")
+    locator_pattern = re.compile(".*\\s([A-Z0-9]+)\\s([A-R]{2}[0-9]{2})$", re.ASCII)
+    wspr_splitter_pattern = re.compile("([A-Z0-9]*)\\s([A-R]{2}[0-9]{2})\\s([0-9]+)", re.ASCII)
 
     def __init__(self, handler):
         self.handler = handler
@@ -198,15 +211,12 @@ class WsjtParser(object):
 
     def parse(self, data):
         try:
-            msg = data.decode().rstrip()
-            # known debug messages we know to skip
-            if msg.startswith("<DecodeFinished>"):
-                return
-            if msg.startswith(" EOF on input file"):
+            # known debug messages we know to skip, filtered before the decode
+            if data.startswith((b"<DecodeFinished>", b" EOF on input file")):
                 return
+            msg = data.decode().rstrip()
 
-            modes = list(WsjtParser.modes.keys())
-            if msg[21] in modes or msg[19] in modes:
+            if msg[21] in WsjtParser.modes or msg[19] in WsjtParser.modes:
                 out = self.parse_from_jt9(msg)
             else:
                 out = self.parse_from_wsprd(msg)
@@ -215,9 +225,21 @@ class WsjtParser(object):
         except ValueError:
             logger.exception("error while parsing wsjt message")
 
-    def parse_timestamp(self, instring, dateformat):
-        ts = datetime.strptime(instring, dateformat)
-        return int(datetime.combine(date.today(), ts.time()).replace(tzinfo=timezone.utc).timestamp() * 1000)
+    # epoch of today's midnight, cached since it only changes once per day
+    day_epoch_cache = (None, 0)
+
+    def parse_timestamp(self, instring):
+        # the decoder timestamps are fixed-width ascii digits (HHMM or HHMMSS);
+        # slicing to int beats strptime by more than an order of magnitude
+        today = date.today()
+        (cached_day, midnight) = WsjtParser.day_epoch_cache
+        if cached_day != today:
+            midnight = int(datetime.combine(today, datetime.min.time()).replace(tzinfo=timezone.utc).timestamp())
+            WsjtParser.day_epoch_cache = (today, midnight)
+        seconds = int(instring[0:2]) * 3600 + int(instring[2:4]) * 60
+        if len(instring) == 6:
+            seconds += int(instring[4:6])
+        return (midnight + seconds) * 1000
 
     def parse_from_jt9(self, msg):
         # ft8 sample
@@ -225,13 +247,9 @@ class WsjtParser(object):
         # jt65 sample
         # '2352  -7  0.4 1801 #  R0WAS R2ABM KO85'
         # '0003  -4  0.4 1762 #  CQ R2ABM KO85'
-        modes = list(WsjtParser.modes.keys())
-        if msg[19] in modes:
-            dateformat = "%H%M"
-        else:
-            dateformat = "%H%M%S"
-        timestamp = self.parse_timestamp(msg[0:len(dateformat)], dateformat)
-        msg = msg[len(dateformat) + 1:]
+        digits = 4 if msg[19] in WsjtParser.modes else 6
+        timestamp = self.parse_timestamp(msg[0:digits])
+        msg = msg[digits + 1:]
         modeChar = msg[14:15]
         mode = WsjtParser.modes[modeChar] if modeChar in WsjtParser.modes else "unknown"
         wsjt_msg = msg[17:53].strip()
@@ -262,7 +280,7 @@ class WsjtParser(object):
         wsjt_msg = msg[29:].strip()
         self.parseWsprMessage(wsjt_msg)
         return {
-            "timestamp": self.parse_timestamp(msg[0:4], "%H%M"),
+            "timestamp": self.parse_timestamp(msg[0:4]),
             "db": float(msg[5:8]),
             "dt": float(msg[9:13]),
             "freq": float(msg[14:24]),